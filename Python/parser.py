@@ -1,9 +1,13 @@
+import functools
 import re
+import string
+import sys
+from array import array
 from parts import Label, StackableWire, StackableSwitch, GateAND, GateOR, GateNOT, Connector, Gyro, ShortStick, StackableButton
 from parts import CompileStack, ConnectionConstants
 
 # Constants
-expression_keywords = [
+expression_keywords = frozenset([
     'and',
     'or',
     'not',
@@ -16,7 +20,51 @@ expression_keywords = [
 
     '(',
     ')'
-]
+])
+
+# Matches either a comment, which is skipped, or a token
+scanner_pattern = re.compile(r'(?P<comment>/[^/]*/)|(?P<token>[A-Za-z0-9_]+|[=();])')
+
+identifier_characters = frozenset(string.ascii_uppercase + string.digits + '_')
+
+# Expression node operators
+OP_AND = 0
+OP_OR = 1
+OP_NOT = 2
+OP_NAND = 3
+OP_NOR = 4
+OP_XOR = 5
+OP_XNOR = 6
+OP_IDENTIFIER = 7
+
+operator_codes = {
+    'and': OP_AND,
+    'or': OP_OR,
+    'nand': OP_NAND,
+    'nor': OP_NOR,
+    'xor': OP_XOR,
+    'xnor': OP_XNOR
+}
+
+# Operator precedences, higher binds tighter
+operator_precedence = {
+    OP_NOT: 3,
+    OP_AND: 2,
+    OP_NAND: 2,
+    OP_OR: 1,
+    OP_NOR: 1,
+    OP_XOR: 1,
+    OP_XNOR: 1
+}
+
+# Chains of these are regrouped into balanced trees
+associative_operators = frozenset((OP_AND, OP_OR, OP_XOR, OP_XNOR))
+
+operator_names = {
+    OP_AND: 'and',
+    OP_OR: 'or',
+    OP_NOT: 'not'
+}
 
 states = {
     'and': [
@@ -36,264 +84,420 @@ states = {
     ]
 }
 
+# Compile plan steps
+STEP_INPUT = 0
+STEP_ALIAS = 1
+STEP_TWO_GATE = 2
+STEP_TRI_GATE = 3
+
+# Variable types
+TYPE_INPUT = 0
+TYPE_VARIABLE = 1
+TYPE_TEMP = 2
+TYPE_OUTPUT = 3
+
+type_names = ('input', 'variable', 'temp', 'output')
+
+# The same names are checked many times, so results are cached
+@functools.lru_cache(maxsize=4096)
+def _is_valid_identifier(s: str):
+    return s != '' and identifier_characters.issuperset(s)
+
 # Class
 class Parser:
     def __init__(self):
-        self._variables = {}
+        # Variables are stored as parallel lists, indexed through _indices
+        self._names = []
+        self._types = array('b')
+        self._values = []
+        self._operands = []
+        self._indices = {}
+
         self._replacements = {}
         self._init_variable_name = '_INIT'
         self._temp_counter = 0
+        self._temp_pool = []
+        self._cse = {}
+        self._negations = {}
+        self._compile_plan = None
 
-    def _check_dict_matches(self, d: dict, strings: list[str]):
-        matches = [key for key in strings if key in d]
+    def _parse_statements(self, code: str):
+        result = []
+        tokens = []
 
-        if len(matches) > 1:
-            raise ValueError(f"Multiple matches found in dictionary keys: {matches}")
-        elif len(matches) == 1:
-            return d[matches[0]]
-        else:
-            return None
+        for match in scanner_pattern.finditer(code):
+            token = match.group('token')
 
-    def _is_valid_identifier(self, s: str):
-        return re.fullmatch(r'[A-Z0-9_]+', s) is not None
+            if token is None:
+                continue
 
-    def _parse_statements(self, code: str):
-        code = re.sub(r'/.*?/', '', code, flags=re.DOTALL)
-        
-        segments = code.split(';')
-        result = []
+            if token == ';':
+                if tokens:
+                    result.append(tokens)
+                    tokens = []
+                continue
 
-        token_pattern = re.compile(r'[A-Za-z0-9_]+|[=()]')
+            # Interned so name lookups and keyword compares hit the identity fast path
+            tokens.append(sys.intern(token))
 
-        for segment in segments:
-            tokens = token_pattern.findall(segment.strip())
-            if tokens:
-                result.append(tokens)
+        if tokens:
+            result.append(tokens)
 
         return result
 
-    # Recursive descent parser for expressions
+    # Shunting-yard parser for expressions
+    # Nodes are emitted in post-order as (operator, left, right) tuples, where
+    # left and right are indices of earlier nodes. Identifiers store their name
+    # in left. The last node is the root of the expression.
     def _parse_expression(self, tokens):
-        def parse_primary(tokens):
-            if not tokens:
-                raise Exception("Unexpected end of expression")
-            
-            token = tokens.pop(0)
-
-            if token == '(':
-                expr = parse_or_nor_xor_xnor(tokens)
-                if not tokens or tokens.pop(0) != ')':
-                    raise Exception("Expected ')'")
-                return expr
-            
-            elif token == 'not':
-                operand = parse_primary(tokens)
+        nodes = []
+        operands = []
+        operators = [] # None marks an open parenthesis
+        init_variable_name = self._init_variable_name
+        is_valid_identifier = _is_valid_identifier
+
+        def emit(op, left, right=-1):
+            nodes.append((op, left, right))
+            return len(nodes) - 1
+
+        # Chains of the same associative operator are kept as [op, operands]
+        # until no more operand can join them, then combined pairwise so the
+        # resulting gates have logarithmic depth instead of a linear chain
+        def finalize(operand):
+            if not isinstance(operand, list):
+                return operand
+
+            op, chain = operand
+            while len(chain) > 1:
+                paired = [emit(op, chain[i], chain[i + 1]) for i in range(0, len(chain) - 1, 2)]
+                if len(chain) % 2:
+                    paired.append(chain[-1])
+                chain = paired
+
+            return chain[0]
+
+        # Finalizes the top operand unless the next operator extends its chain
+        def close(next_op):
+            top = operands[-1]
+            if isinstance(top, list) and top[0] != next_op:
+                operands[-1] = finalize(top)
+
+        def reduce():
+            op = operators.pop()
+
+            if op == OP_NOT:
+                operand = finalize(operands.pop())
                 # This is the change: transform 'not A' into 'not (_INIT or A)'
-                or_expression = [self._init_variable_name, 'or', operand]
-                return ['not', or_expression]
-            
-            elif self._is_valid_identifier(token):
-                return token
+                or_expression = emit(OP_OR, emit(OP_IDENTIFIER, init_variable_name), operand)
+                operands.append(emit(OP_NOT, or_expression))
+                return
+
+            right = finalize(operands.pop())
+            left = operands.pop()
+
+            if isinstance(left, list) and left[0] == op:
+                left[1].append(right)
+            elif op in associative_operators:
+                left = [op, [finalize(left), right]]
             else:
+                left = emit(op, finalize(left), right)
+
+            operands.append(left)
+
+        expect_operand = True
+
+        for token in tokens:
+            if expect_operand:
+                if token == '(':
+                    operators.append(None)
+                elif token == 'not':
+                    operators.append(OP_NOT)
+                elif is_valid_identifier(token):
+                    operands.append(emit(OP_IDENTIFIER, token))
+                    expect_operand = False
+                else:
+                    raise Exception(f"Unexpected token '{token}'")
+                continue
+
+            if token == ')':
+                while operators and operators[-1] is not None:
+                    reduce()
+                if not operators:
+                    raise Exception("Unexpected token ')'")
+                operators.pop()
+                close(None)
+                continue
+
+            op = operator_codes.get(token)
+            if op is None:
                 raise Exception(f"Unexpected token '{token}'")
 
-        # Precedence level 2: and, nand
-        def parse_and_nand(tokens):
-            left = parse_primary(tokens)
-            while tokens and tokens[0] in ('and', 'nand'):
-                op = tokens.pop(0)
-                right = parse_primary(tokens)
-                left = [left, op, right]
-            return left
-
-        # Precedence level 3: or, nor, xor, xnor
-        def parse_or_nor_xor_xnor(tokens):
-            left = parse_and_nand(tokens)
-            while tokens and tokens[0] in ('or', 'nor', 'xor', 'xnor'):
-                op = tokens.pop(0)
-                right = parse_and_nand(tokens)
-                left = [left, op, right]
-            return left
-
-        return parse_or_nor_xor_xnor(tokens)
-
-    def _transform_complex_gates(self, expr_tree):
-        if isinstance(expr_tree, str):
-            return expr_tree # Base case: an identifier
-
-        # Recursively transform operands first
-        if len(expr_tree) == 2 and expr_tree[0] == 'not':
-            operand = self._transform_complex_gates(expr_tree[1])
-            return ['not', operand]
-
-        if len(expr_tree) == 3:
-            left = self._transform_complex_gates(expr_tree[0])
-            op = expr_tree[1]
-            right = self._transform_complex_gates(expr_tree[2])
-
-            if op == 'nand':
+            precedence = operator_precedence[op]
+            while operators and operators[-1] is not None and operator_precedence[operators[-1]] >= precedence:
+                reduce()
+
+            close(op)
+            operators.append(op)
+            expect_operand = True
+
+        if expect_operand:
+            raise Exception("Unexpected end of expression")
+
+        while operators:
+            if operators[-1] is None:
+                raise Exception("Expected ')'")
+            reduce()
+
+        close(None)
+        return nodes
+
+    def _getTemporaryVariableName(self):
+        index = self._temp_counter
+        self._temp_counter = index + 1
+
+        # Names are formatted in batches and reused from the pool
+        pool = self._temp_pool
+        if index >= len(pool):
+            pool.extend(sys.intern(f"_TMP{i}") for i in range(len(pool), index + 64))
+
+        return pool[index]
+
+    def _resolve_alias(self, name):
+        # Follows variables defined as just another variable
+        indices = self._indices
+        values = self._values
+
+        index = indices.get(name)
+        while index is not None and isinstance(values[index], str):
+            name = values[index]
+            index = indices.get(name)
+
+        return name
+
+    def _flatten_expr(self, nodes):
+        # nodes is the post-order array from _parse_expression. Complex gates
+        # are expanded into and, or and not while flattening, identity gates
+        # are folded away, and identical gates share one temporary variable
+        # across the whole program.
+        names = []
+        temp_vars = []
+        cse = self._cse
+        negations = self._negations
+
+        def emit(op, left, right=None):
+            if op == OP_NOT:
+                # not (not A) -> A
+                if left in negations:
+                    return negations[left]
+
+                key = (op, left)
+                value = ['not', left]
+            else:
+                # A and A -> A, A or A -> A
+                if left == right:
+                    return left
+
+                # and, or are commutative
+                key = (op, left, right) if left <= right else (op, right, left)
+                value = [left, operator_names[op], right]
+
+            temp_name = cse.get(key)
+            if temp_name is None:
+                temp_name = self._getTemporaryVariableName()
+                cse[key] = temp_name
+                temp_vars.append((temp_name, value))
+
+                if op == OP_NOT:
+                    negations[temp_name] = left
+
+            return temp_name
+
+        for op, left, right in nodes:
+            if op == OP_IDENTIFIER:
+                names.append(self._resolve_alias(left))
+                continue
+
+            left = names[left]
+
+            if op == OP_NOT:
+                names.append(emit(OP_NOT, left))
+                continue
+
+            right = names[right]
+
+            if op == OP_AND or op == OP_OR: # and, or are fundamental gates
+                temp_name = emit(op, left, right)
+            elif op == OP_NAND:
                 # A nand B -> not (A and B)
-                return ['not', [left, 'and', right]]
-            elif op == 'nor':
+                temp_name = emit(OP_NOT, emit(OP_AND, left, right))
+            elif op == OP_NOR:
                 # A nor B -> not (A or B)
-                return ['not', [left, 'or', right]]
-            elif op == 'xor':
-                # A xor B -> (A and (not B)) or ((not A) and B)
-                not_b = ['not', right]
-                a_and_not_b = [left, 'and', not_b]
-                not_a = ['not', left]
-                not_a_and_b = [not_a, 'and', right]
-                return [a_and_not_b, 'or', not_a_and_b]
-            elif op == 'xnor':
-                # A xnor B -> (A and B) or ((not A) and (not B))
-                a_and_b = [left, 'and', right]
-                not_a = ['not', left]
-                not_b = ['not', right]
-                not_a_and_not_b = [not_a, 'and', not_b]
-                return [a_and_b, 'or', not_a_and_not_b]
-            else: # and, or are fundamental gates
-                return [left, op, right]
-
-        return expr_tree
-    
-    def _getTemporaryVariableName(self):
-        temp_name = f"_TMP{self._temp_counter}"
-        self._temp_counter += 1
-        return temp_name
+                temp_name = emit(OP_NOT, emit(OP_OR, left, right))
+            elif op == OP_XOR:
+                # A xor B -> (A or B) and (not (A and B))
+                a_or_b = emit(OP_OR, left, right)
+                not_a_and_b = emit(OP_NOT, emit(OP_AND, left, right))
+                temp_name = emit(OP_AND, a_or_b, not_a_and_b)
+            elif op == OP_XNOR:
+                # A xnor B -> (A and B) or (not (A or B))
+                a_and_b = emit(OP_AND, left, right)
+                not_a_or_b = emit(OP_NOT, emit(OP_OR, left, right))
+                temp_name = emit(OP_OR, a_and_b, not_a_or_b)
+            else:
+                raise Exception("Invalid expression structure for flattening")
 
-    def _flatten_expr(self, expr):
-        # expr is a nested list/tree of fundamental gates
-        temp_vars = []
-        def flatten(e):
-            if isinstance(e, str):
-                return e
-            if isinstance(e, list):
-                # Flatten nested 'not'
-                if len(e) == 2 and e[0] == 'not':
-                    operand = flatten(e[1])
-
-                    temp_name = self._getTemporaryVariableName()
-                    temp_vars.append((temp_name, ['not', operand]))
-                    return temp_name
-                # Flatten nested binary gates
-                elif len(e) == 3 and e[1] in ('and', 'or'):
-                    left = flatten(e[0])
-                    op = e[1]
-                    right = flatten(e[2])
-
-                    temp_name = self._getTemporaryVariableName()
-                    temp_vars.append((temp_name, [left, op, right]))
-                    return temp_name
-                # Unwrap single-element lists
-                elif len(e) == 1:
-                    return flatten(e[0])
-            raise Exception("Invalid expression structure for flattening")
-        final_var = flatten(expr)
+            names.append(temp_name)
+
+        final_var = names[-1]
         return final_var, temp_vars
 
-    def _parse_variable_line(self, line: list, type: str):
+    def _add_variable(self, name: str, type: int, value, operands: tuple):
+        index = self._indices.get(name)
+
+        if index is None:
+            self._indices[name] = len(self._names)
+            self._names.append(name)
+            self._types.append(type)
+            self._values.append(value)
+            self._operands.append(operands)
+        else:
+            self._types[index] = type
+            self._values[index] = value
+            self._operands[index] = operands
+
+    def _get_operands(self, value):
+        # Resolves the indices of the variables read by a value, so Compile
+        # can reach their wires without looking names up again
+        if isinstance(value, str):
+            names = [value]
+        elif len(value) == 2:
+            names = [value[1]]
+        else:
+            names = [value[0], value[2]]
+
+        operands = []
+        for name in names:
+            index = self._indices.get(name)
+            if index is None:
+                raise Exception("Unknown variable '" + name + "'")
+            operands.append(index)
+
+        return tuple(operands)
+
+    def _parse_variable_line(self, line: list, type: int):
         definer = line[0]
         actual_definer = definer
         original_definer = definer
 
-        if type == 'output' and len(line) == 1:
+        if type == TYPE_OUTPUT and len(line) == 1:
             line.append('=')
             line.append(line[0])
 
         if self._replacements.get(definer):
             actual_definer = self._replacements[definer] 
 
-        if self._variables.get(definer) or self._replacements.get(definer):
+        if definer in self._indices or self._replacements.get(definer):
             temp_name = self._getTemporaryVariableName()
 
             self._replacements[definer] = temp_name
             definer = temp_name
 
         if line[1] != '=':
-            raise Exception("Variable definition must start with '='")
+            raise Exception("Variable definition must start with '=' \n Line: " + ' '.join(line))
 
+        replacements = self._replacements
+        is_valid_identifier = _is_valid_identifier
         expression = []
         
-        for i, item in enumerate(line[2:]):
-            if item not in expression_keywords and not self._is_valid_identifier(item):
+        for item in line[2:]:
+            if item not in expression_keywords and not is_valid_identifier(item):
                 raise Exception("Unknown token '" + item + "'")
             
-            if item in self._replacements and item != original_definer:
-                item = self._replacements[item]
-            elif  item in self._replacements and item == original_definer:
-                item = actual_definer
+            if replacements and item in replacements:
+                item = actual_definer if item == original_definer else replacements[item]
 
             expression.append(item)
 
-        # Step 1: Parse the raw expression into a tree
-        expr_tree_raw = self._parse_expression(expression.copy())
-
-        # Step 2: Transform complex gates into fundamental ones
-        expr_tree_fundamental = self._transform_complex_gates(expr_tree_raw)
+        # Step 1: Parse the raw expression into a node array
+        expr_nodes = self._parse_expression(expression)
 
-        # Step 3: Flatten the fundamental tree into temporary variables
-        final_var, temp_vars = self._flatten_expr(expr_tree_fundamental)
+        # Step 2: Flatten it into temporary variables of fundamental gates
+        final_var, temp_vars = self._flatten_expr(expr_nodes)
         
         for temp_name, temp_expr in temp_vars:
-            self._variables[temp_name] = {
-                'type': 'temp',
-                'value': temp_expr
-            }
-        self._variables[definer] = {
-            'type': type,
-            'value': final_var
-        }
+            self._add_variable(temp_name, TYPE_TEMP, temp_expr, self._get_operands(temp_expr))
+        self._add_variable(definer, type, final_var, self._get_operands(final_var))
 
     def PreCompile(self, code: str):
-        self._variables[self._init_variable_name] = {
-            'type': 'input',
-            'value': None
-        }
-        variables = self._variables
+        self._compile_plan = None
+        self._add_variable(self._init_variable_name, TYPE_INPUT, None, ())
         parsed = self._parse_statements(code)
 
-        for line in parsed:
-            definer = line[0]
-
-            if definer == 'input' or definer == 'output':
-                continue
-
-            if line[1] != '=':
-                raise Exception("Variable definition must start with '=' \n Line: " + ' '.join(line))
-            
-            definition = line[2:]
-            
-
         for line in parsed:
             definer = line[0]
             
             if definer == 'input':
                 if not len(line) == 2:
                     raise Exception("Input must be exactly one value")
-                if not self._is_valid_identifier(line[1]):
+                if not _is_valid_identifier(line[1]):
                     raise Exception("Variable names must contain only uppercase letters, digits, and underscores")
                 
-                variables[line[1]] = {
-                    'type': 'input',
-                    'value': None
-                }
+                self._add_variable(line[1], TYPE_INPUT, None, ())
                 continue
 
             if definer == 'output':
                 line.pop(0)
-                self._parse_variable_line(line, 'output')
+                self._parse_variable_line(line, TYPE_OUTPUT)
                 continue
 
-            if self._is_valid_identifier(definer):
-                self._parse_variable_line(line, 'variable')
+            if _is_valid_identifier(definer):
+                self._parse_variable_line(line, TYPE_VARIABLE)
                 continue
 
             raise Exception("Unknown token '" + definer + "'")
     
-        return variables
+        return {
+            name: {'type': type_names[type], 'value': value}
+            for name, type, value in zip(self._names, self._types, self._values)
+        }
     
+    def _getCompilePlan(self):
+        # Resolves once what Compile does for each variable, as
+        # (step, name, part class, left operand, right operand, is output).
+        # The plan is reused by later Compile calls until the next PreCompile.
+        if self._compile_plan is not None:
+            return self._compile_plan
+
+        plan = []
+
+        for name, type, value, operands in zip(self._names, self._types, self._values, self._operands):
+            if type == TYPE_INPUT:
+                wire_cls = StackableButton if name == self._init_variable_name else StackableSwitch
+                plan.append((STEP_INPUT, name, wire_cls, -1, -1, False))
+                continue
+
+            is_output = type == TYPE_OUTPUT
+
+            gate = None
+            if isinstance(value, list):
+                # ['not', x] or [left, op, right]
+                gate = states.get(value[0] if len(value) == 2 else value[1])
+
+            if gate == None:
+                plan.append((STEP_ALIAS, name, None, operands[0], -1, is_output))
+            elif gate[0] == 2:
+                plan.append((STEP_TWO_GATE, name, gate[2], operands[0], -1, is_output))
+            else:
+                plan.append((STEP_TRI_GATE, name, gate[2], operands[0], operands[1], is_output))
+
+        self._compile_plan = plan
+        return plan
+
     def Compile(self, compile_stack: CompileStack):
-        variables = self._variables
+        plan = self._getCompilePlan()
+
+        # Wire carrying each variable, by variable index
+        wires = [None] * len(plan)
 
         platform_base_connector = Connector()
         platform_stick1, platform_stick2 = ShortStick(), ShortStick()
@@ -344,112 +548,92 @@ class Parser:
         base_connector.connect(platform_stick3, ConnectionConstants.short_stick_cup)
         base_connector.compile(compile_stack)
 
-        gate_connectors = [base_connector]
+        # Only the connector currently receiving gates is kept
+        gate_connector = base_connector
+
+        # Loop invariants bound to locals
+        label_cup = ConnectionConstants.label_cup
+        top_cup = ConnectionConstants.connector_top_cup
+        top_cup_bit = Connector.CupBits[top_cup]
+        connector_bit_cups = Connector.BitCups
+        two_gate_input = ConnectionConstants.two_gate_input
+        two_gate_output = ConnectionConstants.two_gate_output
+        tri_gate_input1 = ConnectionConstants.tri_gate_input1
+        tri_gate_input2 = ConnectionConstants.tri_gate_input2
+        tri_gate_output = ConnectionConstants.tri_gate_output
 
         inputs = []
         outputs = []
         
-        for variable_name, data in variables.items():
-            variable_type = data['type']
-            variable_value = data['value']
-
-            if variable_type == 'input':
+        for i, (step, variable_name, part_cls, left, right, is_output) in enumerate(plan):
+            if step == STEP_INPUT:
                 label = Label(variable_name, -90)
 
-                if variable_name == self._init_variable_name:
-                    wire = StackableButton()
-                else:
-                    wire = StackableSwitch()
-                
-                wire.connect(label, ConnectionConstants.label_cup)
+                wire = part_cls()
+                wire.connect(label, label_cup)
 
-                data['wire'] = wire
+                wires[i] = wire
                 inputs.append(label)
+                continue
 
-            elif variable_type == 'variable' or variable_type == 'temp' or variable_type == 'output':
-                gate = self._check_dict_matches(states, variable_value)
-                wires = []
-                
-                if gate == None:
-                    data['wire'] = variables.get(variable_value, {}).get('wire')
-
-                    if variable_type == 'output':
-                        output_wire = data['wire']
-                        label = Label(variable_name, 90)
-                        
-                        output_wire.connect(label, ConnectionConstants.label_cup)
-                        outputs.append(label)
-
-                    continue
-
-                if gate[0] == 2:
-                    wires.append(variables.get(variable_value[1], {}).get('wire'))
-                elif gate[0] == 3:
-                    wires.append(variables.get(variable_value[0], {}).get('wire'))
-                    wires.append(variables.get(variable_value[2], {}).get('wire'))
-                
-                gate_instance = None
-                output_wire = None
-
-                if gate[0] == 2:
-                    gate_instance = gate[2]()
-                    wires[0].connect(gate_instance, ConnectionConstants.two_gate_input)
-
-                    output_wire = StackableWire()
-                    output_wire.connect(gate_instance, ConnectionConstants.two_gate_output)
-
-                elif gate[0] == 3:
-                    gate_instance = gate[2]()
-                    wires[0].connect(gate_instance, ConnectionConstants.tri_gate_input1)
-                    wires[1].connect(gate_instance, ConnectionConstants.tri_gate_input2)
+            if step == STEP_ALIAS:
+                output_wire = wires[left]
+            else:
+                gate_instance = part_cls()
+                output_wire = StackableWire()
 
-                    output_wire = StackableWire()
-                    output_wire.connect(gate_instance, ConnectionConstants.tri_gate_output)
+                if step == STEP_TWO_GATE:
+                    wires[left].connect(gate_instance, two_gate_input)
+                    output_wire.connect(gate_instance, two_gate_output)
+                else:
+                    wires[left].connect(gate_instance, tri_gate_input1)
+                    wires[right].connect(gate_instance, tri_gate_input2)
+                    output_wire.connect(gate_instance, tri_gate_output)
                 
-                last_connector = gate_connectors[-1]
-                last_connector_cups = [k for k, v in gate_connectors[-1].cups.items() if not v]
-                last_connector_cups.remove(ConnectionConstants.connector_top_cup)
-
-                if len(last_connector_cups) == 0:
-                    last_connector = Connector(rotationZ=180)
-                    last_connector.connect(gate_connectors[-1], ConnectionConstants.connector_top_cup)
-                    last_connector.compile(compile_stack)
+                free_cups = gate_connector.free_cups_mask & ~top_cup_bit
 
-                    last_connector_cups = [k for k, v in last_connector.cups.items() if not v]
-                    last_connector_cups.remove(ConnectionConstants.connector_top_cup)
+                if free_cups == 0:
+                    new_connector = Connector(rotationZ=180)
+                    new_connector.connect(gate_connector, top_cup)
+                    new_connector.compile(compile_stack)
 
-                    gate_connectors.append(last_connector)
+                    gate_connector = new_connector
+                    free_cups = gate_connector.free_cups_mask & ~top_cup_bit
 
-                gate_instance.connect(last_connector, last_connector_cups[0])
+                # Lowest free bit is the first free cup in declaration order
+                gate_instance.connect(gate_connector, connector_bit_cups[free_cups & -free_cups])
                 gate_instance.compile(compile_stack)
-                data['wire'] = output_wire
 
-                if variable_type == 'output':
-                    output_wire = data['wire']
-                    label = Label(variable_name, 90)
-                    
-                    output_wire.connect(label, ConnectionConstants.label_cup)
-                    outputs.append(label)
+            wires[i] = output_wire
+
+            if is_output:
+                label = Label(variable_name, 90)
+                
+                output_wire.connect(label, label_cup)
+                outputs.append(label)
 
         last_connector = Connector()
-        last_connector.connect(gate_connectors[-1], ConnectionConstants.connector_top_cup)
+        last_connector.connect(gate_connector, top_cup)
         last_connector.compile(compile_stack)
 
+        front_cup = ConnectionConstants.connector_front_cup
+        back_cup = ConnectionConstants.connector_back_cup
+
         connectors = [Connector()]
         connectors[0].connect(platform_stick4, ConnectionConstants.short_stick_cup)
         height = max(len(inputs), len(outputs)) * 2
         
         for _ in range(height):
             connector = Connector()
-            connector.connect(connectors[-1], ConnectionConstants.connector_top_cup)
+            connector.connect(connectors[-1], top_cup)
 
             connectors.append(connector)
 
         for i, input_label in enumerate(inputs):
-            input_label.connect(connectors[i * 2], ConnectionConstants.connector_front_cup)
+            input_label.connect(connectors[i * 2], front_cup)
 
         for i, output_label in enumerate(outputs):
-            output_label.connect(connectors[i * 2], ConnectionConstants.connector_back_cup)
+            output_label.connect(connectors[i * 2], back_cup)
         
 
         for connector in connectors:
@@ -461,6 +645,6 @@ class Parser:
         for i, output_label in enumerate(outputs):
             output_label.compile(compile_stack)
 
-        for variable_name, data in variables.items():
-            if 'wire' in data and not data['wire'].__dict__.get('_compiled'):
-                data['wire'].compile(compile_stack)
\ No newline at end of file
+        for wire in wires:
+            if wire is not None and not wire._compiled:
+                wire.compile(compile_stack)
\ No newline at end of file
@@ -1,7 +1,12 @@
 import base64
 import json
 
-from typing import Protocol, Dict, TypeVar, Generic, List, get_args
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from typing import Protocol, TypeVar, Generic, Dict, List, get_args
 
 # Constants
 class ConnectionConstants:
@@ -35,82 +40,120 @@ class ConnectionConstants:
 
 # Classes
 class HasCups(Protocol):
-    cups: Dict[int, bool]
+    CupBits: Dict[int, int]
+    free_cups_mask: int
 
 class CompileStack:
     def __init__(self):
-        self._stack = []
-        self._items = []
+        # Compact JSON array of the compiled parts, written as they are
+        # appended. A part's id is its position starting at 1.
+        self._buffer = bytearray(b'[')
+        self._count = 0
+        self._terminated = False
     
-    def append(self, stackItem, classItem):
-        self._stack.append(stackItem)
-        self._items.append(classItem)
-        return len(self._stack)
+    def _dumps(self, value) -> bytes:
+        # Both produce the same compact JSON
+        if orjson is not None:
+            return orjson.dumps(value)
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def append(self, part):
+        if self._count:
+            self._buffer += b','
+        self._buffer += self._dumps([part.Name, part._positions, part._datas])
+
+        self._count += 1
+        return self._count
     
     def terminate(self):
-        encoded = base64.b64encode(json.dumps(self._stack).encode('utf-8'))
+        # The array is closed in place to avoid copying the whole payload
+        if not self._terminated:
+            self._buffer += b']'
+            self._terminated = True
+
+        encoded = base64.b64encode(self._buffer)
         return encoded.decode('utf-8')
 
 class BaseItem:
+    __slots__ = ('_id', '_compiled', 'free_attachments_mask', 'free_cups_mask', '_positions', '_datas')
+
     Attachments = {}
     Cups = {}
     Name = ""
 
+    # Attachments and cups bitmasks, bit i standing for the i-th entry
+    AttachmentBits = {}
+    BitAttachments = {}
+    AttachmentsMask = 0
+
+    CupBits = {}
+    BitCups = {}
+    CupsMask = 0
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+
+        cls.AttachmentBits = {attachment: 1 << i for i, attachment in enumerate(cls.Attachments)}
+        cls.BitAttachments = {bit: attachment for attachment, bit in cls.AttachmentBits.items()}
+        cls.AttachmentsMask = (1 << len(cls.Attachments)) - 1
+
+        cls.CupBits = {cup: 1 << i for i, cup in enumerate(cls.Cups)}
+        cls.BitCups = {bit: cup for cup, bit in cls.CupBits.items()}
+        cls.CupsMask = (1 << len(cls.Cups)) - 1
+
     def __init__(self):
         self._id = -1
         self._compiled = False
-        self.attachments = self.Attachments.copy()
-        self.cups = self.Cups.copy()
+        self.free_attachments_mask = self.AttachmentsMask
+        self.free_cups_mask = self.CupsMask
         self._positions = []
         self._datas = {}
 
     def _getEmptyAttachment(self):
-        foundId = -1
+        free_attachments = self.free_attachments_mask
 
-        for attachmentId, used in self.attachments.items():
-            if used == False:
-                foundId = attachmentId
-                break
+        if not free_attachments:
+            return -1
 
-        return foundId
+        return self.BitAttachments[free_attachments & -free_attachments]
 
     def connect(self, element: HasCups, cup):
-        if element.cups[cup] == True:
+        cup_bit = element.CupBits.get(cup)
+
+        if cup_bit is None:
+            raise Exception("Unknown cup !")
+        if not element.free_cups_mask & cup_bit:
             raise Exception("Cup is already used !")
         attachment = self._getEmptyAttachment()
 
         if attachment == -1:
             raise Exception("No found empty attachment !")
 
-        self.attachments[attachment] = True
-        element.cups[cup] = True
+        self.free_attachments_mask &= ~self.AttachmentBits[attachment]
+        element.free_cups_mask &= ~cup_bit
 
-        if element._id != -1:
-            element = element._id
-
-        self._positions.append([attachment, cup, element])
+        # The element is resolved to its id when this part is compiled
+        self._positions.append((attachment, cup, element))
     
     def compile(self, stack: CompileStack):
-        item = [self.Name]
         self._compiled = True
 
-        for position in self._positions:
-            if isinstance(position[2], int):
-                continue
-            
-            if position[2]._id == -1:
+        positions = []
+        for attachment, cup, element in self._positions:
+            element_id = element._id
+            if element_id == -1:
                 raise Exception("All connections are not compiled !")
             
-            position[2] = position[2]._id
-        
-        item.append(self._positions)
-        item.append(self._datas)
+            positions.append((attachment, cup, element_id))
+
+        self._positions = positions
 
-        id = stack.append(item, self)
-        self._id = id
+        self._id = stack.append(self)
 
 # Gates
 class GateAND(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.gate_attachment: False
     }
@@ -122,6 +165,8 @@ class GateAND(BaseItem):
     Name = "Gate-AND"
 
 class GateOR(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.gate_attachment: False
     }
@@ -133,6 +178,8 @@ class GateOR(BaseItem):
     Name = "Gate-OR"
     
 class GateNOT(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.gate_attachment: False
     }
@@ -144,6 +191,8 @@ class GateNOT(BaseItem):
 
 # Base parts
 class Connector(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.connector_bottom_attachment: False
     }
@@ -164,6 +213,8 @@ class Connector(BaseItem):
             self._datas["OrientationZ"] = rotationZ
 
 class ShortStick(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.short_stick_attachment: False
     }
@@ -173,33 +224,21 @@ class ShortStick(BaseItem):
     Name = "ShortStick"
 
 class Gyro(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.gyro_attachement: False
     }
     Name = "Gyro"
 
-    def compile(self, stack: CompileStack):
-        item = [self.Name]
-        self._compiled = True
-
-        for position in self._positions:
-            if isinstance(position[2], int):
-                continue
-            
-            if position[2]._id == -1:
-                raise Exception("All connections are not compiled !")
-            
-            position[2] = position[2]._id
-        
-        item.append(self._positions)
-
-        datas = {"Activated":True}
-        item.append(datas)
+    def __init__(self):
+        super().__init__()
 
-        id = stack.append(item, self)
-        self._id = id
+        self._datas = {"Activated": True}
 
 class Label(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.label_attachment: False
     }
@@ -217,6 +256,8 @@ class Label(BaseItem):
 
 # Wire types
 class Wire(BaseItem):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.wire_ball_attachment1: False,
         ConnectionConstants.wire_ball_attachment2: False
@@ -228,6 +269,8 @@ class Wire(BaseItem):
     Name = "Wire"
 
 class Switch(Wire):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.wire_ball_attachment2: False,
         ConnectionConstants.wire_ball_attachment1: False
@@ -238,6 +281,8 @@ class Switch(Wire):
     Name = "Switch"
 
 class Button(Wire):
+    __slots__ = ()
+
     Attachments = {
         ConnectionConstants.wire_ball_attachment2: False,
         ConnectionConstants.wire_ball_attachment1: False
@@ -252,6 +297,8 @@ A = TypeVar('A', bound='Wire')
 B = TypeVar('B', bound='Wire')
 
 class StackableWireType(BaseItem, Generic[A, B]):
+    __slots__ = ('name', '_items')
+
     _item_cls: type
     _base_cls: type
 
@@ -262,42 +309,35 @@ class StackableWireType(BaseItem, Generic[A, B]):
         cls._item_cls = generic_args[0]
         cls._base_cls = generic_args[1]
 
+        # The stack starts with the free cups and attachments of one item
+        item_cls = cls._item_cls
+        cls.AttachmentBits = item_cls.AttachmentBits
+        cls.BitAttachments = item_cls.BitAttachments
+        cls.AttachmentsMask = item_cls.AttachmentsMask
+
+        cls.CupBits = item_cls.CupBits
+        cls.BitCups = item_cls.BitCups
+        cls.CupsMask = item_cls.CupsMask
+
     def __init__(self):
         super().__init__()
 
-        self.cups = self._item_cls.Cups.copy()
-        self.attachments = self._item_cls.Attachments.copy()
         self.name = self._base_cls.Name
 
         self._items: List[A] = [self._base_cls()]
 
     def _getLatestItem(self) -> A:
+        # Items are only appended once every previous one is full, so the
+        # last item is the only one that can have a free attachment
         last_item = self._items[-1]
-        for item in self._items:
-            free_attachments = [k for k, v in item.attachments.items() if not v]
-            if free_attachments:
-                return item
+        if last_item.free_attachments_mask:
+            return last_item
 
-        free_cups = [k for k, v in last_item.cups.items() if not v]
+        free_cups = last_item.free_cups_mask
         new_item = self._item_cls()
-        new_item.connect(last_item, free_cups[0])
+        new_item.connect(last_item, last_item.BitCups[free_cups & -free_cups])
         self._items.append(new_item)
         return new_item
-
-    @property
-    def _id(self):
-        possible_ids = []
-        for item in self._items:
-            if item._id == -1:
-                continue
-            possible_ids.append([item._id, len([k for k, v in item.cups.items() if not v])])
-        if not possible_ids:
-            return -1
-        return max(possible_ids, key=lambda x: x[1])[0]
-
-    @_id.setter
-    def _id(self, value):
-        pass
     
     def connect(self, element: 'HasCups', cup):
         latest_item = self._getLatestItem()
@@ -305,17 +345,31 @@ class StackableWireType(BaseItem, Generic[A, B]):
 
     def compile(self, stack: 'CompileStack'):
         self._compiled = True
+
+        # The wire is referred to by its item with the most free cups
+        most_free_cups = -1
         for item in self._items:
             item.compile(stack=stack)
 
+            free_cups = item.free_cups_mask.bit_count()
+            if free_cups > most_free_cups:
+                most_free_cups = free_cups
+                self._id = item._id
+
 class StackableWire(StackableWireType[Wire, Wire]):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
 
 class StackableSwitch(StackableWireType[Wire, Switch]):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
 
 class StackableButton(StackableWireType[Wire, Button]):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__()
\ No newline at end of file
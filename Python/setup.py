@@ -0,0 +1,20 @@
+from setuptools import setup
+
+# Compile the parser ahead-of-time when Cython is available,
+# otherwise parser.py is used as plain Python.
+try:
+    from Cython.Build import cythonize
+    from setuptools import Extension
+
+    ext_modules = cythonize(
+        [Extension("parser", ["parser.py"])],
+        compiler_directives={'language_level': 3, 'annotation_typing': False}
+    )
+except ImportError:
+    ext_modules = []
+
+setup(
+    name="grambyscript",
+    py_modules=["parser", "parts"],
+    ext_modules=ext_modules
+)
@@ -510,36 +510,39 @@ class Parser {
     }
 
     _parse_expression(tokens) {
-        const parse_or_nor_xor_xnor = (tkns) => {
-            let left = parse_and_nand(tkns);
-            while (tkns.length > 0 && ['or', 'nor', 'xor', 'xnor'].includes(tkns[0])) {
-                const op = tkns.shift();
-                const right = parse_and_nand(tkns);
+        let pos = 0;
+
+        const parse_or_nor_xor_xnor = () => {
+            let left = parse_and_nand();
+            while (pos < tokens.length && ['or', 'nor', 'xor', 'xnor'].includes(tokens[pos])) {
+                const op = tokens[pos++];
+                const right = parse_and_nand();
                 left = [left, op, right];
             }
             return left;
         };
 
-        const parse_and_nand = (tkns) => {
-            let left = parse_primary(tkns);
-            while (tkns.length > 0 && ['and', 'nand'].includes(tkns[0])) {
-                const op = tkns.shift();
-                const right = parse_primary(tkns);
+        const parse_and_nand = () => {
+            let left = parse_primary();
+            while (pos < tokens.length && ['and', 'nand'].includes(tokens[pos])) {
+                const op = tokens[pos++];
+                const right = parse_primary();
                 left = [left, op, right];
             }
             return left;
         };
         
-        const parse_primary = (tkns) => {
-            if (tkns.length === 0) throw new Error("Unexpected end of expression");
+        const parse_primary = () => {
+            if (pos >= tokens.length) throw new Error("Unexpected end of expression");
             
-            const token = tkns.shift();
+            const token = tokens[pos++];
             if (token === '(') {
-                const expr = parse_or_nor_xor_xnor(tkns);
-                if (tkns.length === 0 || tkns.shift() !== ')') throw new Error("Expected ')'");
+                const expr = parse_or_nor_xor_xnor();
+                if (pos >= tokens.length || tokens[pos] !== ')') throw new Error("Expected ')'");
+                pos++;
                 return expr;
             } else if (token === 'not') {
-                const operand = parse_primary(tkns);
+                const operand = parse_primary();
                 return ['not', operand]; // FIX: Don't inject _INIT here.
             } else if (this._is_valid_identifier(token)) {
                 return token;
@@ -548,7 +551,7 @@ class Parser {
             }
         };
 
-        return parse_or_nor_xor_xnor(tokens);
+        return parse_or_nor_xor_xnor();
     }
     
     _transform_complex_gates(expr_tree) {
@@ -686,7 +689,7 @@ class Parser {
         }
 
         // CORRECTED ORDER OF OPERATIONS
-        const expr_tree_raw = this._parse_expression([...expression]);
+        const expr_tree_raw = this._parse_expression(expression);
         const expr_tree_fundamental = this._transform_complex_gates(expr_tree_raw);
         const expr_tree_with_init = this._inject_init_reset(expr_tree_fundamental); // New step
         const [final_var, temp_vars] = this._flatten_expr(expr_tree_with_init);